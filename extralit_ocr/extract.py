@@ -1,25 +1,32 @@
 from __future__ import annotations
 
+import contextlib
 import hashlib
+import json
 import logging
 import os
+import tempfile
 import time
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Optional, Union
 
 import pymupdf
 import pymupdf4llm
-from extralit_server.api.schemas.v1.document.metadata import (
-    DocumentProcessingMetadata,
-)
 
 LOGGER = logging.getLogger(__name__)
 
+# Anything pymupdf.open(stream=...) takes; bytes and memoryviews (e.g. over an mmap or a download buffer) are used
+# without copying
+PdfBuffer = Union[bytes, bytearray, memoryview]
+
 # ---------------------------------------------------------------------------
 # Configuration
 # ---------------------------------------------------------------------------
 
+# Upper bound on PDF size handed to MuPDF; image-heavy scans can need many times their size in RAM
+MAX_PDF_BYTES = int(os.getenv("PDF_MAX_BYTES", 50 << 20))
+
 
 @dataclass
 class ExtractionConfig:
@@ -30,6 +37,9 @@ class ExtractionConfig:
     header_detection_body_limit: int = 10
     safe_filename_timestamp: bool = True
     safe_filename_hash_len: int = 8
+    cache_results: bool = True  # reuse results for identical PDF bytes + config under write_dir/.cache
+    cache_max_entries: int = 512  # oldest results beyond this are evicted from write_dir/.cache; 0 keeps all
+    max_bytes: int = MAX_PDF_BYTES  # 0 disables the size check
 
     # internal cached Path (not user supplied directly)
     _write_dir_path: Optional[Path] = field(init=False, default=None, repr=False)
@@ -70,8 +80,10 @@ def generate_safe_filename(
     parts = [stem]
 
     if hash_len > 0:
-        digest = hashlib.sha1(original_name.encode("utf-8", errors="ignore")).hexdigest()[:hash_len]
-        parts.append(digest)
+        # blake2b sized to the requested length: hash_len=8 -> 4-byte digest -> exactly 8 hex chars
+        digest_size = min(64, max(4, (hash_len + 1) // 2))
+        digest = hashlib.blake2b(original_name.encode("utf-8", errors="ignore"), digest_size=digest_size)
+        parts.append(digest.hexdigest()[:hash_len])
 
     if include_timestamp:
         parts.append(str(int(time.time())))
@@ -79,6 +91,97 @@ def generate_safe_filename(
     return "-".join(parts) + suffix
 
 
+def content_fingerprint(file_bytes: PdfBuffer) -> str:
+    """
+    Fingerprint raw PDF bytes. Shared key for everything cached per document content.
+    """
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+
+def extraction_cache_key(fingerprint: str, config: ExtractionConfig) -> str:
+    """
+    Key identifying the extraction result for this content fingerprint + config.
+    """
+    # Only the settings that change the extracted markdown take part in the key
+    cfg_key = repr((tuple(config.margins), config.header_detection_max_levels, config.header_detection_body_limit))
+    cfg_hash = hashlib.blake2b(cfg_key.encode("utf-8"), digest_size=8).hexdigest()
+    return f"{fingerprint}-{cfg_hash}"
+
+
+def _cache_path(file_bytes: PdfBuffer, config: ExtractionConfig, fingerprint: Optional[str] = None) -> Optional[Path]:
+    """
+    Location of the cached extraction result for this content + config, or None if caching is disabled.
+
+    The content is only hashed (when no ``fingerprint`` is given) once caching is known to be enabled.
+    """
+    write_dir = config.write_dir_path
+    if not write_dir or not config.cache_results:
+        return None
+    key = extraction_cache_key(fingerprint or content_fingerprint(file_bytes), config)
+    return write_dir / ".cache" / f"{key}.json"
+
+
+def _read_cached_extraction(cache_path: Path) -> Optional[tuple[str, dict[str, Any]]]:
+    try:
+        payload = json.loads(cache_path.read_bytes())
+        return payload["markdown"], payload["metadata"]
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError, OSError) as e:
+        LOGGER.warning("Ignoring unreadable extraction cache entry %s: %s", cache_path, e)
+        return None
+
+
+def _write_cached_extraction(
+    cache_path: Path, markdown_text: str, metadata: dict[str, Any], max_entries: int = 0
+) -> None:
+    """
+    Atomically store an extraction result; concurrent writers of the same key are harmless.
+
+    With ``max_entries``, the oldest results beyond that count are then evicted from the cache directory.
+    """
+    tmp_name = None
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=cache_path.parent, suffix=".tmp", delete=False) as tmp:
+            tmp_name = tmp.name
+            # Compact separators and raw UTF-8 instead of \uXXXX escapes: smaller and cheaper for large markdown
+            payload = json.dumps(
+                {"markdown": markdown_text, "metadata": metadata}, ensure_ascii=False, separators=(",", ":")
+            )
+            tmp.write(payload.encode("utf-8"))
+        os.replace(tmp_name, cache_path)
+    except OSError as e:
+        LOGGER.warning("Failed to write extraction cache entry %s: %s", cache_path, e)
+        if tmp_name:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_name)
+        return
+
+    if max_entries:
+        _evict_cached_extractions(cache_path.parent, max_entries)
+
+
+def _evict_cached_extractions(cache_dir: Path, max_entries: int) -> None:
+    """
+    Remove the least recently written results in ``cache_dir`` until at most ``max_entries`` remain.
+    """
+    try:
+        with os.scandir(cache_dir) as it:
+            entries = [(entry.stat().st_mtime, entry.path) for entry in it if entry.name.endswith(".json")]
+    except OSError as e:
+        LOGGER.warning("Failed to scan extraction cache %s: %s", cache_dir, e)
+        return
+
+    if len(entries) <= max_entries:
+        return
+    entries.sort()
+    for _, path in entries[: len(entries) - max_entries]:
+        # Another worker may have evicted it already
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+
+
 def write_markdown_output(
     markdown_text: str,
     original_filename: str,
@@ -110,108 +213,102 @@ def write_markdown_output(
     return str(out_path)
 
 
-def extract_document_margins(metadata: DocumentProcessingMetadata) -> tuple[int, int, int, int] | None:
-    """
-    Fetch margins from document metadata in database.
-
-    Returns:
-        Tuple of (left, top, right, bottom) margins in PDF points, or None if not found
-    """
-    try:
-        if (
-            not metadata.analysis_metadata
-            or not metadata.analysis_metadata.layout_analysis
-            or not metadata.analysis_metadata.layout_analysis.margin_analysis
-        ):
-            LOGGER.debug("No layout analysis or margin data found in document metadata")
-            return None
-
-        margin_analysis = metadata.analysis_metadata.layout_analysis.margin_analysis
-        LOGGER.debug("Found margin analysis data: %s", margin_analysis)
-
-        # Convert pixels to PDF points (multiply by 0.75)
-        if all(key in margin_analysis for key in ["left_px", "top_px", "right_px", "bottom_px"]):
-            left = int(margin_analysis["left_px"])
-            top = int(margin_analysis["top_px"])
-            right = int(margin_analysis["right_px"])
-            bottom = int(margin_analysis["bottom_px"])
-
-            margins = (left, top, right, bottom)
-            LOGGER.info("Using document-specific margins: %s", margins)
-            return margins
-
-    except Exception as e:
-        LOGGER.warning(f"Error retrieving margins for document: {e}", exc_info=True)
-
-    return None
-
-
 def extract_markdown_with_hierarchy(
-    file_bytes: bytes,
+    file_bytes: PdfBuffer,
     original_filename: str,
     *,
     config: Optional[ExtractionConfig] = None,
+    metadata_only: bool = False,
+    fingerprint: Optional[str] = None,
 ) -> tuple[str, dict[str, Any]]:
     """
     Extract hierarchical Markdown from a PDF (bytes) using either the embedded
     Table of Contents (TOC) or a heuristic header identification fallback.
 
     Args:
-        file_bytes: Raw PDF bytes.
+        file_bytes: Raw PDF bytes, or a buffer over them (e.g. ``memoryview(mmap)``) to avoid a copy.
         original_filename: Original name (used only for generated markdown filename).
         config: Optional ExtractionConfig. If omitted, environment-derived default is used.
+        metadata_only: Only read the page count and TOC size, skipping header detection and
+            markdown conversion. Nothing is cached or written.
+        fingerprint: ``content_fingerprint(file_bytes)``, if the caller already computed it.
 
     Returns:
-        A tuple: (markdown_text, metadata_dict)
+        A tuple: (markdown_text, metadata_dict). With ``metadata_only`` the text is empty and the
+        metadata holds just ``pages`` and ``toc_entries``.
 
     Raises:
-        ValueError: On invalid input or extraction failure.
+        ValueError: On invalid or oversized input, or extraction failure.
     """
     if not file_bytes:
         raise ValueError("Empty PDF content")
 
     cfg = config or _DEFAULT_CONFIG
-
+    if cfg.max_bytes and len(file_bytes) > cfg.max_bytes:
+        raise ValueError(f"PDF too large: {len(file_bytes)} bytes exceeds limit of {cfg.max_bytes}")
+    # Readers accept the header anywhere in the first 1 KiB, so do the same instead of a strict startswith
+    if b"%PDF-" not in bytes(file_bytes[:1024]):
+        raise ValueError("Not a PDF (missing %PDF- header)")
+
+    cache_path = None
+    if not metadata_only:
+        cache_path = _cache_path(file_bytes, cfg, fingerprint)
+        cached = _read_cached_extraction(cache_path) if cache_path else None
+        if cached is not None:
+            md_text, metadata = cached
+            LOGGER.debug("Extraction cache hit: %s", cache_path)
+            metadata["output_path"] = write_markdown_output(md_text, original_filename, cfg)
+            return md_text, metadata
+
+    # pymupdf.open copies a bytearray into a new bytes object but reads a memoryview in place
+    stream = memoryview(file_bytes) if isinstance(file_bytes, bytearray) else file_bytes
     try:
-        doc = pymupdf.open(stream=file_bytes)
+        doc = pymupdf.open(stream=stream)
     except Exception as e:  # pragma: no cover - external library specifics
         raise ValueError(f"Failed to open PDF: {e}") from e
 
-    toc = doc.get_toc()
-    toc_entry_count = len(toc) if toc else 0
-
-    headers_strategy = ""
-    header_levels_detected: Optional[int] = None
-
     try:
-        if toc_entry_count > 0:
-            headers_strategy = "toc"
-            toc_headers = pymupdf4llm.TocHeaders(doc)
-            md_text = pymupdf4llm.to_markdown(doc, hdr_info=toc_headers, margins=cfg.margins)
-            # TOC format: list of [level, title, page_num]
-            header_levels_detected = len({level for level, _, _ in toc})
-            LOGGER.debug("Used TocHeaders with %d TOC entries", toc_entry_count)
-        else:
-            headers_strategy = "identify"
-            identified = pymupdf4llm.IdentifyHeaders(
-                doc,
-                max_levels=cfg.header_detection_max_levels,
-                body_limit=cfg.header_detection_body_limit,
-            )
-            md_text = pymupdf4llm.to_markdown(doc, hdr_info=identified, margins=cfg.margins)
-            # Attempt to extract distinct levels if the object exposes .headers
-            try:  # pragma: no cover - depends on library internals
-                header_levels_detected = len({h.level for h in identified.headers})  # type: ignore[attr-defined]
-            except Exception:
-                header_levels_detected = None
-            LOGGER.debug("Used IdentifyHeaders heuristic")
-    except Exception as e:  # pragma: no cover - external library specifics
-        raise ValueError(f"Markdown conversion failed: {e}") from e
-
-    write_path = write_markdown_output(md_text, original_filename, cfg)
+        with doc:
+            toc = doc.get_toc()
+            toc_entry_count = len(toc) if toc else 0
+            page_count = doc.page_count
+            if metadata_only:
+                return "", {"pages": page_count, "toc_entries": toc_entry_count}
+
+            headers_strategy = ""
+            header_levels_detected: Optional[int] = None
+
+            try:
+                if toc_entry_count > 0:
+                    headers_strategy = "toc"
+                    toc_headers = pymupdf4llm.TocHeaders(doc)
+                    md_text = pymupdf4llm.to_markdown(doc, hdr_info=toc_headers, margins=cfg.margins)
+                    # TOC format: list of [level, title, page_num]
+                    header_levels_detected = len({level for level, _, _ in toc})
+                    LOGGER.debug("Used TocHeaders with %d TOC entries", toc_entry_count)
+                else:
+                    headers_strategy = "identify"
+                    identified = pymupdf4llm.IdentifyHeaders(
+                        doc,
+                        max_levels=cfg.header_detection_max_levels,
+                        body_limit=cfg.header_detection_body_limit,
+                    )
+                    md_text = pymupdf4llm.to_markdown(doc, hdr_info=identified, margins=cfg.margins)
+                    # Attempt to extract distinct levels if the object exposes .headers
+                    try:  # pragma: no cover - depends on library internals
+                        header_levels_detected = len({h.level for h in identified.headers})  # type: ignore[attr-defined]
+                    except Exception:
+                        header_levels_detected = None
+                    LOGGER.debug("Used IdentifyHeaders heuristic")
+            except Exception as e:  # pragma: no cover - external library specifics
+                raise ValueError(f"Markdown conversion failed: {e}") from e
+    finally:
+        # The document's native buffers are released on leaving `with`; also trim MuPDF's global
+        # font/pixmap store, which is unbounded by default and otherwise keeps long-lived workers at peak RSS
+        pymupdf.TOOLS.store_shrink(100)
 
     metadata: dict[str, Any] = {
-        "pages": doc.page_count,
+        "pages": page_count,
         "toc_entries": toc_entry_count,
         "headers_strategy": headers_strategy,
         "header_levels_detected": header_levels_detected,
@@ -221,9 +318,12 @@ def extract_markdown_with_hierarchy(
             "right": cfg.margins[2],
             "bottom": cfg.margins[3],
         },
-        "output_path": write_path,
         "output_size_chars": len(md_text),
     }
+    if cache_path:
+        _write_cached_extraction(cache_path, md_text, metadata, cfg.cache_max_entries)
+
+    metadata["output_path"] = write_markdown_output(md_text, original_filename, cfg)
     return md_text, metadata
 
 
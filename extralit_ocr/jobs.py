@@ -2,32 +2,329 @@
 RQ job for PDF extraction using PyMuPDF with S3 integration.
 """
 
+import asyncio
+import hashlib
+import json
 import logging
+import struct
 import time
+from collections.abc import Coroutine
 from datetime import datetime, timezone
-from typing import Any
+from typing import Any, TypedDict, TypeVar
 from uuid import UUID
 
-from extralit_server.api.schemas.v1.document.metadata import DocumentProcessingMetadata, TextExtractionMetadata
-from extralit_server.contexts.files import download_file_content, get_s3_client
+from extralit_server.api.schemas.v1.document.metadata import TextExtractionMetadata
+from extralit_server.contexts.files import get_proxy_document_url, get_s3_client, put_object
 from extralit_server.database import AsyncSessionLocal
 from extralit_server.jobs.queues import OCR_QUEUE, REDIS_CONNECTION
 from extralit_server.models.database import Document
+from redis.exceptions import LockError, RedisError
+from redis.lock import Lock
 from rq import get_current_job
 from rq.decorators import job
+from rq.job import Job
+from sqlalchemy import bindparam, select, update
 
-from extralit_ocr.extract import ExtractionConfig, extract_document_margins, extract_markdown_with_hierarchy
+from extralit_ocr.extract import (
+    MAX_PDF_BYTES,
+    ExtractionConfig,
+    content_fingerprint,
+    extract_markdown_with_hierarchy,
+    extraction_cache_key,
+)
+from extralit_ocr.margins import extract_document_margins
+from extralit_ocr.storage import download_file_ranged
 
 _LOGGER = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+class PymupdfJobResult(TypedDict):
+    """
+    Return value of ``pymupdf_to_markdown_job``, pickled by RQ into Redis. Kept small: the markdown itself is in S3.
+    """
+
+    document_id: str
+    markdown_s3_url: str
+    extraction_metadata: dict[str, Any]
+    processing_time: float
+    success: bool
+
+
+# The metadata reads this module issues, built once: SQLAlchemy's compiled cache then serves every job, and asyncpg
+# reuses its server-side prepared statement per connection. The locking variant backs _persist's read-merge-write
+# (SQLite has no row locks and ignores FOR UPDATE).
+_METADATA_STMT = select(Document.metadata_).where(Document.id == bindparam("document_id"))
+_METADATA_FOR_UPDATE_STMT = _METADATA_STMT.with_for_update()
+
+# Event loop for the job's async I/O, see _run()
+_LOOP: asyncio.AbstractEventLoop | None = None
+
+# Margins per document and workflow run, shared by all workers (each RQ job runs in its own forked work horse, so
+# nothing cached in process memory outlives the job), as four packed int32. Keyed by the workflow_id the server
+# records in the job meta, so a re-uploaded or re-analysed document misses; the TTL only has to cover retries and
+# duplicate enqueues of the same run. Documents without margins are not cached: the layout analysis runs alongside
+# this job, so "no margins yet" may be stale by the next attempt.
+_MARGIN_REDIS_PREFIX = "ocr:margins:"
+_MARGIN_REDIS_TTL = 300  # seconds
+_MARGIN_STRUCT = struct.Struct("<4i")
+
+# Extraction results shared across workers, keyed by the PDF's full content fingerprint + extraction config, so
+# retried or duplicate jobs skip the extraction. Entries are small pointers (S3 URL + digest of the uploaded markdown,
+# extraction metadata): the markdown itself stays in S3, not in the Redis that also serves as the RQ broker.
+_RESULT_REDIS_PREFIX = "ocr:mdcache:"
+_RESULT_REDIS_TTL = 86400  # seconds
+
+# Jobs for the same document run one at a time, so a duplicate (retry, double enqueue) finds the first one's result
+# in the extraction cache instead of parsing the PDF again. The lock expires with the job timeout. The wait is kept
+# short, since a waiting job holds one of the few worker processes idle: a duplicate of a job that has not finished
+# by then extracts on its own
+_INFLIGHT_REDIS_PREFIX = "ocr:inflight:"
+_INFLIGHT_LOCK_TIMEOUT = 900  # seconds
+_INFLIGHT_WAIT = 10  # seconds
+
+# Jobs still running after this many seconds save their meta before the final save
+_META_SAVE_AFTER = 30.0
+
+
+def _run(coro: Coroutine[Any, Any, T]) -> T:
+    """
+    Run a coroutine on this process's event loop.
+
+    asyncpg connections are bound to the loop that opened them, so every I/O phase of a job must share one loop
+    rather than each getting a fresh one from ``asyncio.run``. The loop lives as long as the process, i.e. the
+    forked work horse running the job.
+    """
+    global _LOOP
+    if _LOOP is None or _LOOP.is_closed():
+        _LOOP = asyncio.new_event_loop()
+    return _LOOP.run_until_complete(coro)
+
+
+async def _get_s3_client() -> Any:
+    """
+    The server's S3 client.
+
+    ``get_s3_client`` keeps it in the server's shared resources, so later calls and jobs reuse it; it is not this
+    module's to close.
+    """
+    client = await get_s3_client()
+    if client is None:
+        raise Exception("Failed to get storage client")
+    return client
+
+
+async def _get_document_margins(document_id: UUID, workflow_id: str | None) -> tuple[int, int, int, int] | None:
+    """
+    Margins recorded by layout analysis for a document.
+
+    Served from Redis when this workflow run already read them (shared by all workers), and otherwise from the
+    database. Jobs enqueued outside a workflow always read the database.
+
+    Raises:
+        Exception: If the document does not exist.
+    """
+    redis_key = f"{_MARGIN_REDIS_PREFIX}{document_id}:{workflow_id}" if workflow_id else None
+    packed = None
+    if redis_key:
+        try:
+            packed = REDIS_CONNECTION.get(redis_key)
+        except RedisError as e:
+            _LOGGER.warning("Margin cache lookup failed for document %s: %s", document_id, e)
+    if packed is not None and len(packed) == _MARGIN_STRUCT.size:
+        return _MARGIN_STRUCT.unpack(packed)
+
+    # Short-lived session, so no pooled connection sits idle while the extraction runs
+    # Only the metadata column: hydrating a full Document would load every column to read one
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(_METADATA_STMT, {"document_id": document_id})).one_or_none()
+    if row is None:
+        raise Exception(f"Document with ID {document_id} not found in database")
+    margins = extract_document_margins(row.metadata_)
+
+    if redis_key and margins:
+        try:
+            REDIS_CONNECTION.set(redis_key, _MARGIN_STRUCT.pack(*margins), ex=_MARGIN_REDIS_TTL)
+        except RedisError as e:
+            _LOGGER.warning("Failed to cache margins for document %s: %s", document_id, e)
+    return margins
+
+
+def _markdown_digest(markdown_bytes: bytes | bytearray) -> str:
+    return hashlib.blake2b(markdown_bytes, digest_size=16).hexdigest()
+
+
+async def _get_cached_result(cache_key: str) -> tuple[str, dict[str, Any], str] | None:
+    """
+    A previous extraction for ``cache_key``, with its markdown read back from S3.
+
+    Returns:
+        ``(markdown, extraction_metadata, markdown_s3_url)``, or None on a miss, including when the markdown object
+        is gone or no longer matches the digest recorded with it
+    """
+    try:
+        payload = REDIS_CONNECTION.get(f"{_RESULT_REDIS_PREFIX}{cache_key}")
+        if payload is None:
+            return None
+        cached = json.loads(payload)
+        markdown_s3_url, digest, extraction_metadata = cached["markdown_s3_url"], cached["digest"], cached["metadata"]
+    except (RedisError, ValueError, KeyError, TypeError) as e:
+        _LOGGER.warning("Ignoring extraction cache entry %s: %s", cache_key, e)
+        return None
+
+    try:
+        markdown_bytes = await download_file_ranged(await _get_s3_client(), markdown_s3_url)
+    except Exception as e:
+        # Deleted or unreadable: extract again
+        _LOGGER.info("Cached markdown %s unavailable, extracting again: %s", markdown_s3_url, e)
+        return None
+    if _markdown_digest(markdown_bytes) != digest:
+        _LOGGER.debug("Cached markdown %s was overwritten since, extracting again", markdown_s3_url)
+        return None
+    return markdown_bytes.decode("utf-8"), extraction_metadata, markdown_s3_url
+
+
+def _set_cached_result(
+    cache_key: str, markdown_s3_url: str, markdown: str, extraction_metadata: dict[str, Any]
+) -> None:
+    try:
+        payload = json.dumps(
+            {
+                "markdown_s3_url": markdown_s3_url,
+                "digest": _markdown_digest(markdown.encode("utf-8")),
+                "metadata": extraction_metadata,
+            },
+            separators=(",", ":"),
+        )
+        REDIS_CONNECTION.set(f"{_RESULT_REDIS_PREFIX}{cache_key}", payload, ex=_RESULT_REDIS_TTL)
+    except (RedisError, TypeError, ValueError) as e:
+        _LOGGER.warning("Failed to cache extraction result %s: %s", cache_key, e)
+
+
+def _acquire_inflight(document_id: UUID) -> Lock | None:
+    """
+    Take the per-document extraction lock, waiting for a job already processing this document.
+
+    Returns:
+        The held lock, or None if it could not be taken (timed out, Redis unavailable)
+    """
+    lock = REDIS_CONNECTION.lock(
+        f"{_INFLIGHT_REDIS_PREFIX}{document_id}", timeout=_INFLIGHT_LOCK_TIMEOUT, blocking_timeout=_INFLIGHT_WAIT
+    )
+    try:
+        if lock.acquire():
+            return lock
+        _LOGGER.warning(
+            "Document %s still locked by another job after %ss, extracting anyway", document_id, _INFLIGHT_WAIT
+        )
+    except RedisError as e:
+        _LOGGER.warning("Failed to lock document %s for extraction: %s", document_id, e)
+    return None
+
+
+def _release_inflight(lock: Lock | None) -> None:
+    if lock is None:
+        return
+    try:
+        lock.release()
+    except (LockError, RedisError) as e:
+        # Expired or already taken over: nothing left to release
+        _LOGGER.debug("Failed to release extraction lock %s: %s", lock.name, e)
+
+
+def _save_meta(current_job: Job) -> None:
+    """
+    Write the job's meta to Redis; a failure is logged rather than raised, so it cannot fail the job or mask the
+    job's own exception.
+    """
+    try:
+        current_job.save_meta()
+    except RedisError as e:
+        _LOGGER.warning("Failed to save meta for job %s: %s", current_job.id, e)
+
+
+async def _fetch(
+    document_id: UUID, s3_url: str, workflow_id: str | None
+) -> tuple[bytearray, tuple[int, int, int, int] | None]:
+    """
+    Download the PDF and look up the document's margins.
+
+    Returns:
+        The PDF bytes and the margins (None if not recorded)
+    """
+
+    async def download() -> bytearray:
+        # Oversized PDFs are rejected from the response headers, before the download buffer is allocated
+        return await download_file_ranged(await _get_s3_client(), s3_url, max_bytes=MAX_PDF_BYTES)
+
+    # Independent I/O: the margin query completes behind the (usually longer) client setup and download
+    pdf_data, margins = await asyncio.gather(download(), _get_document_margins(document_id, workflow_id))
+
+    return pdf_data, margins
+
+
+async def _persist(document_id: UUID, workspace_name: str, markdown: str, *, stored_s3_url: str | None = None) -> str:
+    """
+    Upload the markdown to S3 and record the extraction on the document.
+
+    Args:
+        stored_s3_url: Where this exact markdown is already stored (an extraction cache hit); the upload is skipped
+            when that is the document's own markdown object.
+
+    Returns:
+        The markdown's URL, in the server's ``/api/v1/file/{bucket}/{key}`` form like ``Document.url``
+    """
+    # Persist markdown to S3 so the RQ result kept in Redis carries a pointer, not the full text
+    markdown_object = f"markdown/{document_id}.md"
+    markdown_s3_url = get_proxy_document_url(workspace_name, markdown_object)
+    if stored_s3_url != markdown_s3_url:
+        markdown_bytes = markdown.encode("utf-8")
+        await put_object(
+            await _get_s3_client(),
+            workspace_name,
+            markdown_object,
+            data=markdown_bytes,
+            content_type="text/markdown",
+        )
+
+    # Read-merge-write in one short transaction, reading the current row rather than one loaded before the
+    # extraction, so edits made to other keys meanwhile are kept. The row stays locked (SELECT ... FOR UPDATE) until
+    # the commit, so a concurrent write cannot land between the read and the UPDATE and be lost. Only the new key
+    # is validated; the rest of the stored tree is merged back as-is rather than round-tripped through
+    # DocumentProcessingMetadata.
+    text_extraction_metadata = TextExtractionMetadata(
+        markdown=markdown,
+        extraction_method="pymupdf4llm",
+    )
+
+    async with AsyncSessionLocal() as db:
+        document_metadata = await db.scalar(_METADATA_FOR_UPDATE_STMT, {"document_id": document_id})
+        await db.execute(
+            update(Document)
+            .where(Document.id == document_id)
+            .values(
+                metadata_={
+                    **(document_metadata or {}),
+                    "text_extraction_metadata": text_extraction_metadata.model_dump(),
+                }
+            )
+        )
+        await db.commit()
+    _LOGGER.info("Updated document %s metadata with extraction results", document_id)
+
+    return markdown_s3_url
+
 
 @job(queue=OCR_QUEUE, connection=REDIS_CONNECTION, timeout=900, result_ttl=3600)
-async def pymupdf_to_markdown_job(
+def pymupdf_to_markdown_job(
     document_id: UUID, s3_url: str, filename: str, analysis_metadata: dict[str, Any], workspace_name: str
-) -> dict[str, Any]:
+) -> PymupdfJobResult:
     """
     Extract PDF text using PyMuPDF, downloading from S3.
 
+    Synchronous on purpose: the extraction is CPU-bound, so only the S3/database I/O runs on the event loop.
+
     Args:
         document_id: UUID of document to process
         s3_url: S3 URL of the PDF file
@@ -36,7 +333,7 @@ async def pymupdf_to_markdown_job(
         workspace_name: Workspace name for S3 operations
 
     Returns:
-        Dictionary with extraction results
+        Dictionary with extraction results, see ``PymupdfJobResult``
     """
     current_job = get_current_job()
     if current_job is None:
@@ -51,64 +348,58 @@ async def pymupdf_to_markdown_job(
             "started_at": datetime.now(timezone.utc).isoformat(),
         }
     )
-    current_job.save_meta()
+    job_start = time.monotonic()
+    inflight = _acquire_inflight(document_id)
 
     try:
-        # Step 1: Download PDF from S3
-        client = await get_s3_client()
-        if client is None:
-            raise Exception("Failed to get storage client")
-
-        pdf_data = await download_file_content(client, s3_url)
-
-        async with AsyncSessionLocal() as db:
-            document: Document | None = await db.get(Document, document_id)
-            if document is None:
-                raise Exception(f"Document with ID {document_id} not found in database")
-
-            if document and document.metadata_:
-                metadata = DocumentProcessingMetadata(**document.metadata_)
-            else:
-                metadata = DocumentProcessingMetadata()
-
-            margins = extract_document_margins(metadata)
-            if margins:
-                config = ExtractionConfig(margins=margins)
-            else:
-                # Use default margins if none found
-                config = ExtractionConfig()
-
-            # Step 2: Extract markdown using PyMuPDF
-            extraction_start = time.time()
-            markdown, extraction_metadata = extract_markdown_with_hierarchy(pdf_data, filename, config=config)
-            extraction_time = time.time() - extraction_start
-
-            # Step 3: Prepare results
-            result = {
-                "document_id": str(document_id),
-                "markdown": markdown,
-                "extraction_metadata": extraction_metadata,
-                "processing_time": extraction_time,
-                "success": True,
-            }
-
-            # Step 4: Update document metadata in database
-            metadata.text_extraction_metadata = TextExtractionMetadata(
-                markdown=markdown,
-                extraction_method="pymupdf4llm",
+        # Step 1: Download PDF from S3 and read the document's margins
+        pdf_data, margins = _run(_fetch(document_id, s3_url, current_job.meta.get("workflow_id")))
+
+        if margins:
+            config = ExtractionConfig(margins=margins)
+        else:
+            # Use default margins if none found
+            config = ExtractionConfig()
+
+        # Step 2: Extract markdown using PyMuPDF, unless this content was already extracted with this config
+        extraction_start = time.monotonic_ns()
+        fingerprint = content_fingerprint(pdf_data)
+        cache_key = extraction_cache_key(fingerprint, config)
+        cached = _run(_get_cached_result(cache_key))
+        if cached is not None:
+            markdown, extraction_metadata, stored_s3_url = cached
+            _LOGGER.debug("Reusing cached extraction for document %s from %s", document_id, stored_s3_url)
+        else:
+            markdown, extraction_metadata = extract_markdown_with_hierarchy(
+                pdf_data, filename, config=config, fingerprint=fingerprint
             )
+            stored_s3_url = None
+        extraction_time = (time.monotonic_ns() - extraction_start) / 1e9
+        if time.monotonic() - job_start > _META_SAVE_AFTER:
+            _save_meta(current_job)
 
-            document.metadata_ = metadata.model_dump()
-            await db.commit()
-            _LOGGER.info(f"Updated document {document_id} metadata with extraction results")
+        # Step 3: Upload markdown and update document metadata
+        markdown_s3_url = _run(_persist(document_id, workspace_name, markdown, stored_s3_url=stored_s3_url))
+        if cached is None:
+            _set_cached_result(cache_key, markdown_s3_url, markdown, extraction_metadata)
+
+        result: PymupdfJobResult = {
+            "document_id": str(document_id),
+            "markdown_s3_url": markdown_s3_url,
+            "extraction_metadata": extraction_metadata,
+            "processing_time": extraction_time,
+            "success": True,
+        }
 
         current_job.meta.update({"success": True, "text_length": len(markdown)})
-        current_job.save_meta()
 
         return result
 
     except Exception as e:
-        _LOGGER.error(f"Error in PyMuPDF extraction for document {document_id}: {e}")
+        _LOGGER.error("Error in PyMuPDF extraction for document %s: %s", document_id, e)
         current_job.meta.update({"success": False, "error": str(e)})
-        current_job.save_meta()
         raise
+
+    finally:
+        _release_inflight(inflight)
+        _save_meta(current_job)
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import logging
+from typing import Any, Optional, TypedDict
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Shape of the part of ``Document.metadata_`` read here. Typing only: a TypedDict is a plain dict at runtime, so the
+# lookup stays free of validation/conversion cost. Keys mirror DocumentProcessingMetadata's nested models.
+class MarginAnalysis(TypedDict, total=False):
+    left_px: float
+    top_px: float
+    right_px: float
+    bottom_px: float
+
+
+class LayoutAnalysis(TypedDict, total=False):
+    margin_analysis: Optional[MarginAnalysis]
+
+
+class AnalysisMetadata(TypedDict, total=False):
+    layout_analysis: Optional[LayoutAnalysis]
+
+
+# Four lookups per read instead of a membership scan followed by re-indexing
+_MARGIN_KEYS = ("left_px", "top_px", "right_px", "bottom_px")
+
+
+def _child(node: Any, key: str) -> Any:
+    """
+    ``node[key]`` if ``node`` is a JSON object, else None, so an unexpected shape just means "no margins".
+    """
+    return node.get(key) if isinstance(node, dict) else None
+
+
+def _read_margins(node: MarginAnalysis) -> tuple[int, int, int, int] | None:
+    """
+    The four ``*_px`` margins in ``node``, or None unless each has a non-null value.
+    """
+    left_key, top_key, right_key, bottom_key = _MARGIN_KEYS
+    values = (node.get(left_key), node.get(top_key), node.get(right_key), node.get(bottom_key))
+    if None in values:
+        return None
+    left, top, right, bottom = values
+    return int(left), int(top), int(right), int(bottom)
+
+
+def extract_document_margins(metadata: Optional[dict[str, Any]]) -> tuple[int, int, int, int] | None:
+    """
+    Fetch margins from a document's raw ``metadata_`` JSON, as stored in the database.
+
+    Walks ``analysis_metadata.layout_analysis.margin_analysis`` directly instead of validating the whole
+    tree into ``DocumentProcessingMetadata`` just to read four numbers.
+
+    Returns:
+        Tuple of (left, top, right, bottom) margins in PDF points, or None if not found
+    """
+    try:
+        analysis_metadata: Optional[AnalysisMetadata] = _child(metadata, "analysis_metadata")
+        layout_analysis: Optional[LayoutAnalysis] = _child(analysis_metadata, "layout_analysis")
+        margin_analysis: Optional[MarginAnalysis] = _child(layout_analysis, "margin_analysis")
+        if not margin_analysis or not isinstance(margin_analysis, dict):
+            LOGGER.debug("No layout analysis or margin data found in document metadata")
+            return None
+
+        LOGGER.debug("Found margin analysis data: %s", margin_analysis)
+        # The *_px values are used as PDF points unscaled
+        margins = _read_margins(margin_analysis)
+        if margins is None:
+            return None
+
+        LOGGER.debug("Using document-specific margins: %s", margins)
+        return margins
+
+    except (TypeError, ValueError, OverflowError) as e:
+        # Malformed margin values (non-numeric, NaN/inf); the traceback only helps when debugging
+        LOGGER.warning("Error retrieving margins for document: %s", e, exc_info=LOGGER.isEnabledFor(logging.DEBUG))
+
+    return None
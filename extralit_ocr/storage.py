@@ -0,0 +1,161 @@
+"""
+S3 download helpers for the OCR jobs.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import inspect
+import logging
+from typing import Any
+from urllib.parse import urlparse
+
+LOGGER = logging.getLogger(__name__)
+
+# Objects up to one chunk are fetched with a single GET; larger ones are split into byte ranges fetched in parallel,
+# since a single stream is bound by time-to-first-byte rather than bandwidth
+RANGE_CHUNK_SIZE = 8 << 20
+RANGE_MAX_CONCURRENCY = 8
+# Read size when streaming a response body into the download buffer
+STREAM_READ_SIZE = 1 << 20
+# Path prefix of the server's file proxy URLs, followed by {bucket}/{key}
+PROXY_URL_PREFIX = "/api/v1/file/"
+
+
+def split_s3_url(s3_url: str) -> tuple[str, str]:
+    """
+    Split a document URL into its bucket and object key.
+
+    Accepts the server's file proxy form ``/api/v1/file/{bucket}/{key}`` (what ``Document.url`` holds, see
+    ``files.get_proxy_document_url``), ``s3://bucket/key`` and a bare ``bucket/key``.
+
+    Raises:
+        ValueError: For any other scheme (e.g. an ``http://`` endpoint URL), or a missing bucket or key.
+    """
+    parsed = urlparse(s3_url)
+    if parsed.scheme not in ("", "s3"):
+        raise ValueError(f"Invalid S3 URL (unsupported scheme {parsed.scheme!r}): {s3_url}")
+    if parsed.scheme == "s3":
+        path = f"{parsed.netloc}{parsed.path}"
+    elif s3_url.startswith(PROXY_URL_PREFIX):
+        path = s3_url[len(PROXY_URL_PREFIX) :]
+    else:
+        path = s3_url
+    bucket, _, key = path.lstrip("/").partition("/")
+    if not bucket or not key:
+        raise ValueError(f"Invalid S3 URL: {s3_url}")
+    return bucket, key
+
+
+def _object_size(response: dict[str, Any], requested: int) -> int | None:
+    """
+    Size of the whole object from the response to a GET for its first ``requested`` bytes.
+
+    The total in ``ContentRange`` (``bytes 0-99/12345``) when the server reports one. Without it, a server that
+    ignored Range sent the whole object, and one that honoured it silently (the server's ``LocalFileClient``)
+    sent at most ``requested`` bytes, so ``ContentLength`` is the size unless exactly ``requested`` bytes came
+    back. None in that last case, where the size is unknown.
+    """
+    content_range = response.get("ContentRange")
+    if content_range:
+        return int(content_range.rpartition("/")[2])
+    length = int(response["ContentLength"])
+    return None if length == requested else length
+
+
+async def _release(body: Any) -> None:
+    """
+    Release a response body without reading it.
+    """
+    if hasattr(body, "__aenter__"):
+        async with body:
+            return
+    close = getattr(body, "close", None)
+    if close is not None:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+
+
+async def _stream_into(response: dict[str, Any], view: memoryview, what: str) -> None:
+    """
+    Stream a GET response body into ``view``, which must be exactly the body's size.
+    """
+    body = response["Body"]
+    offset = 0
+    if hasattr(body, "iter_chunks"):
+        async with body as stream:
+            async for chunk in stream.iter_chunks(STREAM_READ_SIZE):
+                end = offset + len(chunk)
+                if end > len(view):
+                    raise OSError(f"{what} is larger than its Content-Length")
+                view[offset:end] = chunk
+                offset = end
+    else:
+        # LocalFileClient's MockAsyncStreamingBody only offers read()
+        data = await body.read()
+        offset = len(data)
+        if offset > len(view):
+            raise OSError(f"{what} is larger than its Content-Length")
+        view[:offset] = data
+    if offset != len(view):
+        raise OSError(f"Short read for {what}: got {offset} of {len(view)} bytes")
+
+
+async def download_file_ranged(
+    client: Any,
+    s3_url: str,
+    *,
+    chunk_size: int = RANGE_CHUNK_SIZE,
+    max_concurrency: int = RANGE_MAX_CONCURRENCY,
+    max_bytes: int = 0,
+) -> bytearray:
+    """
+    Download an S3 object, using concurrent ranged GETs when it is larger than ``chunk_size``.
+
+    The first GET asks for the first chunk and learns the object's size from its headers, so objects up to
+    ``chunk_size`` take a single request and larger ones need no HEAD before splitting. Only a server that honours
+    Range without a ``ContentRange`` header, and returns a full first chunk, costs a HEAD. The buffer is allocated
+    once from that size and response bodies are streamed into it, so no intermediate chunk list or growing
+    ``bytes`` is built.
+
+    Args:
+        max_bytes: Largest object accepted; checked against the size in the first response's headers, before
+            anything is allocated or read. 0 disables the check.
+
+    Returns:
+        The object's content as a bytearray filled in place, which ``extract_markdown_with_hierarchy``
+        hands to PyMuPDF without another copy
+
+    Raises:
+        ValueError: If the object is larger than ``max_bytes``.
+    """
+    bucket, key = split_s3_url(s3_url)
+    first = await client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{chunk_size - 1}")
+    size = _object_size(first, chunk_size)
+    if size is None:
+        size = int((await client.head_object(Bucket=bucket, Key=key))["ContentLength"])
+    if max_bytes and size > max_bytes:
+        # Release the connection without reading the body
+        await _release(first["Body"])
+        raise ValueError(f"PDF too large: {size} bytes exceeds limit of {max_bytes}")
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    # A server ignoring Range answers with the whole object, which is then already complete
+    received = int(first["ContentLength"])
+    await _stream_into(first, view[:received], f"{s3_url} bytes 0-{received - 1}")
+    if received >= size:
+        return buffer
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch_range(start: int) -> None:
+        end = min(start + chunk_size, size)
+        byte_range = f"bytes={start}-{end - 1}"
+        async with semaphore:
+            response = await client.get_object(Bucket=bucket, Key=key, Range=byte_range)
+            await _stream_into(response, view[start:end], f"{s3_url} {byte_range}")
+
+    await asyncio.gather(*(fetch_range(start) for start in range(received, size, chunk_size)))
+    LOGGER.debug("Downloaded %s (%d bytes) in %d ranges", s3_url, size, -(-size // chunk_size))
+    return buffer
@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+from extralit_ocr.storage import download_file_ranged, split_s3_url
+
+
+class FakeBody:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.read_calls = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def iter_chunks(self, chunk_size: int):
+        self.read_calls += 1
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start : start + chunk_size]
+
+
+class FakeS3Client:
+    """
+    S3-like ``get_object``: honours ``Range`` and reports the object's total size in ``ContentRange``.
+    """
+
+    def __init__(self, objects: dict[tuple[str, str], bytes]):
+        self.objects = objects
+        self.requests: list[tuple[str, str, str | None]] = []
+        self.bodies: list[FakeBody] = []
+
+    async def get_object(self, Bucket: str, Key: str, Range: str | None = None):
+        self.requests.append((Bucket, Key, Range))
+        data = self.objects[(Bucket, Key)]
+        response = {}
+        if Range:
+            start, _, end = Range.removeprefix("bytes=").partition("-")
+            start, end = int(start), min(int(end), len(data) - 1)
+            response["ContentRange"] = f"bytes {start}-{end}/{len(data)}"
+            data = data[start : end + 1]
+        body = FakeBody(data)
+        self.bodies.append(body)
+        response.update(Body=body, ContentLength=len(data))
+        return response
+
+
+class ReadOnlyBody:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+
+class LocalFileClient(FakeS3Client):
+    """
+    Like the server's ``LocalFileClient``: honours ``Range`` but reports no ``ContentRange``, and its bodies have
+    only ``read()``.
+    """
+
+    async def get_object(self, Bucket: str, Key: str, Range: str | None = None):
+        response = await super().get_object(Bucket, Key, Range)
+        del response["ContentRange"]
+        response["Body"] = ReadOnlyBody(response["Body"].data)
+        return response
+
+    async def head_object(self, Bucket: str, Key: str):
+        self.requests.append((Bucket, Key, "HEAD"))
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+
+@pytest.mark.parametrize(
+    "url, expected",
+    [
+        ("/api/v1/file/workspace/pdf/paper.pdf", ("workspace", "pdf/paper.pdf")),
+        ("/api/v1/file/workspace/nested/dir/paper v2.pdf", ("workspace", "nested/dir/paper v2.pdf")),
+        ("s3://workspace/pdf/paper.pdf", ("workspace", "pdf/paper.pdf")),
+        ("workspace/pdf/paper.pdf", ("workspace", "pdf/paper.pdf")),
+    ],
+)
+def test_split_s3_url(url, expected):
+    assert split_s3_url(url) == expected
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://minio.local/workspace/pdf/paper.pdf",
+        "/api/v1/file/workspace",
+        "/api/v1/file/",
+        "s3://workspace",
+        "",
+    ],
+)
+def test_split_s3_url_rejects(url):
+    with pytest.raises(ValueError):
+        split_s3_url(url)
+
+
+def test_download_single_chunk():
+    data = b"%PDF-1.7 small"
+    client = FakeS3Client({("workspace", "pdf/paper.pdf"): data})
+
+    result = asyncio.run(download_file_ranged(client, "/api/v1/file/workspace/pdf/paper.pdf", chunk_size=64))
+
+    assert result == data
+    assert client.requests == [("workspace", "pdf/paper.pdf", "bytes=0-63")]
+
+
+def test_download_ranges():
+    data = bytes(range(256)) * 10
+    client = FakeS3Client({("workspace", "pdf/paper.pdf"): data})
+
+    result = asyncio.run(
+        download_file_ranged(client, "/api/v1/file/workspace/pdf/paper.pdf", chunk_size=1000, max_concurrency=2)
+    )
+
+    assert result == data
+    assert sorted(r for _, _, r in client.requests) == ["bytes=0-999", "bytes=1000-1999", "bytes=2000-2559"]
+
+
+def test_download_rejects_oversized_before_reading():
+    client = FakeS3Client({("workspace", "pdf/paper.pdf"): b"x" * 100})
+
+    with pytest.raises(ValueError, match="too large"):
+        asyncio.run(download_file_ranged(client, "/api/v1/file/workspace/pdf/paper.pdf", chunk_size=10, max_bytes=50))
+
+    assert len(client.requests) == 1
+    assert client.bodies[0].read_calls == 0
+
+
+@pytest.mark.parametrize("size, requests", [(40, 1), (100, 2), (2560, 27)])
+def test_download_without_content_range(size, requests):
+    data = bytes(range(256)) * 10
+    data = data[:size]
+    client = LocalFileClient({("workspace", "pdf/paper.pdf"): data})
+
+    result = asyncio.run(download_file_ranged(client, "/api/v1/file/workspace/pdf/paper.pdf", chunk_size=100))
+
+    assert result == data
+    assert len(client.requests) == requests